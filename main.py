@@ -1,227 +1,425 @@
+import hashlib
 import os
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from datetime import datetime, timezone
-import requests
-
-from database import db, create_document, get_documents
+from typing import Optional
+import httpx
+import orjson
+from bson.codec_options import CodecOptions
+from cachetools import TTLCache
+from pymongo import ReturnDocument
+
+from database import db, create_document
+from schemas import Quiz as QuizIn, Resume as ResumeIn, CoverLetterIn
+
+# Environment is read once at import (after database.py runs load_dotenv)
+# rather than on every request.
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+DATABASE_URL_SET = bool(os.getenv("DATABASE_URL"))
+DATABASE_NAME_SET = bool(os.getenv("DATABASE_NAME"))
+FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "https://app.sensai.example")
+ENABLE_DEBUG_ENDPOINTS = bool(os.getenv("ENABLE_DEBUG_ENDPOINTS"))
+
+# Shared client so every OpenAI call reuses one keep-alive HTTP/2 connection
+# instead of paying a fresh TCP+TLS handshake per request.
+openai_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
 
-app = FastAPI(title="SENSAI Backend")
+# Collection handles resolved once at import with tz-aware datetime
+# decoding, instead of building a default handle on every request.
+_CODEC_OPTIONS = CodecOptions(tz_aware=True)
+quiz_coll = db["quiz"].with_options(codec_options=_CODEC_OPTIONS) if db is not None else None
+resume_coll = db["resume"].with_options(codec_options=_CODEC_OPTIONS) if db is not None else None
+
+_ready = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _ready
+    if db is not None:
+        # Pay the Mongo handshake + server selection before serving traffic
+        await db.command("ping")
+        # get_quiz_stats / get_recent_quizzes filter by user_id and order by
+        # created_at desc; this index turns both from COLLSCANs into index scans.
+        await db["quiz"].create_index([("user_id", 1), ("created_at", -1)])
+        await db["resume"].create_index([("user_id", 1)], unique=True)
+    if OPENAI_API_KEY:
+        # Open the TLS connection to OpenAI so the first cover letter
+        # doesn't pay the handshake; failure here is not fatal
+        try:
+            await openai_client.get(
+                "https://api.openai.com/v1/models",
+                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                timeout=5,
+            )
+        except httpx.HTTPError:
+            pass
+    _ready = True
+    yield
+    _ready = False
+    await openai_client.aclose()
+
+
+app = FastAPI(
+    title="SENSAI Backend",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[FRONTEND_ORIGIN],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    # Let browsers cache the preflight for a day instead of re-sending
+    # OPTIONS before every cross-origin call
+    max_age=86400,
 )
 
+class SSEAwareGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that leaves SSE endpoints uncompressed.
 
-@app.get("/")
-def read_root():
-    return {"message": "SENSAI API is running"}
-
-
-# --------- Models ---------
-class QuizIn(BaseModel):
-    user_id: str
-    score: int = Field(..., ge=0, le=100)
-    total_questions: int = Field(..., ge=1)
-    correct_answers: int = Field(..., ge=0)
-    feedback: Optional[str] = None
+    Starlette's compressor never flushes between chunks, so gzipping the
+    cover-letter stream would buffer every token until the stream closes.
+    """
 
+    SSE_PATHS = {"/api/cover-letter"}
 
-class ResumeExperience(BaseModel):
-    company: str
-    role: str
-    start: str
-    end: str
-    description: Optional[str] = None
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.SSE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
 
-class ResumeEducation(BaseModel):
-    school: str
-    degree: str
-    start: str
-    end: str
-    details: Optional[str] = None
+# Compress JSON bodies over 512 bytes; tiny responses aren't worth the CPU
+app.add_middleware(SSEAwareGZipMiddleware, minimum_size=512)
 
 
-class ResumeProject(BaseModel):
-    name: str
-    link: Optional[str] = None
-    description: Optional[str] = None
+@app.get("/")
+async def read_root():
+    return {"message": "SENSAI API is running"}
 
 
-class ResumeIn(BaseModel):
-    user_id: str
-    email: Optional[str] = None
-    linkedin: Optional[str] = None
-    twitter: Optional[str] = None
-    summary: Optional[str] = None
-    skills: List[str] = []
-    experiences: List[ResumeExperience] = []
-    education: List[ResumeEducation] = []
-    projects: List[ResumeProject] = []
+@app.get("/livez")
+async def livez():
+    # Pure in-process liveness check: no DB round trip
+    return {"ok": True}
 
 
-class CoverLetterIn(BaseModel):
-    company_name: str
-    job_title: str
-    job_description: str
-    user_name: Optional[str] = None
+@app.get("/readyz")
+async def readyz():
+    # Only 200 once the lifespan warm-up has finished, so orchestrators
+    # don't route traffic to a cold instance
+    if not _ready:
+        raise HTTPException(status_code=503, detail="Not ready")
+    if db is not None:
+        await db.command("ping")
+    return {"ok": True}
 
 
 # --------- Quiz Endpoints ---------
 @app.post("/api/quiz")
-def create_quiz_result(payload: QuizIn):
-    doc = payload.model_dump()
-    doc["created_at"] = datetime.now(timezone.utc)
-    doc["updated_at"] = datetime.now(timezone.utc)
-    inserted_id = create_document("quiz", doc)
+async def create_quiz_result(payload: QuizIn):
+    now = datetime.now(timezone.utc)
+    doc = payload.model_dump(exclude_unset=True)
+    doc["created_at"] = doc["updated_at"] = now
+    inserted_id = await create_document("quiz", doc)
     return {"id": inserted_id, "ok": True}
 
 
 @app.get("/api/quiz/stats")
-def get_quiz_stats(user_id: str):
-    items = get_documents("quiz", {"user_id": user_id})
-    if not items:
+async def get_quiz_stats(user_id: str):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"created_at": -1}},
+        {
+            "$group": {
+                "_id": None,
+                "average_score": {"$avg": "$score"},
+                "total_questions": {"$sum": "$total_questions"},
+                "latest_score": {"$first": "$score"},
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    results = await quiz_coll.aggregate(pipeline).to_list(length=1)
+    if not results:
         return {
             "average_score": 0,
             "total_questions": 0,
             "latest_score": 0,
             "count": 0,
         }
-    scores = [it.get("score", 0) for it in items]
-    total_questions = sum(int(it.get("total_questions", 0)) for it in items)
-    latest = sorted(items, key=lambda x: x.get("created_at", datetime.min))[-1]
+    stats = results[0]
     return {
-        "average_score": round(sum(scores) / len(scores), 2),
-        "total_questions": total_questions,
-        "latest_score": latest.get("score", 0),
-        "count": len(items),
+        "average_score": round(stats.get("average_score") or 0, 2),
+        "total_questions": stats.get("total_questions", 0),
+        "latest_score": stats.get("latest_score", 0),
+        "count": stats.get("count", 0),
     }
 
 
 @app.get("/api/quiz/recent")
-def get_recent_quizzes(user_id: str, limit: int = 5):
-    items = get_documents("quiz", {"user_id": user_id}, limit=limit)
-    # Sort by created_at desc if present
-    items_sorted = sorted(items, key=lambda x: x.get("created_at", datetime.min), reverse=True)
-    return items_sorted
+async def get_recent_quizzes(user_id: str, limit: int = 5):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    # Sort + limit server-side so Mongo only ships the newest documents
+    cursor = (
+        quiz_coll
+        .find({"user_id": user_id}, {"_id": 0})
+        .sort("created_at", -1)
+        .limit(limit)
+    )
+    return await cursor.to_list(length=limit)
 
 
 # --------- Resume Endpoints ---------
+# Top-level field names a client may project; anything else is rejected
+# before it reaches Mongo
+_RESUME_FIELDS = set(ResumeIn.model_fields) | {"created_at", "updated_at"}
 @app.post("/api/resume")
-def upsert_resume(payload: ResumeIn):
+async def upsert_resume(payload: ResumeIn):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    coll = db["resume"]
+    now = datetime.now(timezone.utc)
     payload_dict = payload.model_dump()
-    payload_dict["updated_at"] = datetime.now(timezone.utc)
-    payload_dict.setdefault("created_at", datetime.now(timezone.utc))
-    coll.update_one({"user_id": payload.user_id}, {"$set": payload_dict}, upsert=True)
-    return {"ok": True}
+    payload_dict["updated_at"] = now
+    # Return the saved document so clients don't need a follow-up GET
+    doc = await resume_coll.find_one_and_update(
+        {"user_id": payload.user_id},
+        {"$set": payload_dict, "$setOnInsert": {"created_at": now}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        projection={"_id": 0},
+    )
+    return doc
 
 
 @app.get("/api/resume")
-def get_resume(user_id: str):
+async def get_resume(user_id: str, fields: Optional[str] = None):
+    # Optional ?fields=summary,skills projection so large resumes aren't
+    # decoded and shipped in full when only part of one is needed
+    projection = {"_id": 0}
+    if fields:
+        requested = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = requested - _RESUME_FIELDS
+        if unknown:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Unknown fields: {', '.join(sorted(unknown))}",
+            )
+        projection.update({f: 1 for f in requested})
+        # Never let the client re-include _id; ObjectId isn't JSON-serializable
+        projection["_id"] = 0
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    doc = db["resume"].find_one({"user_id": user_id}, {"_id": 0})
+    doc = await resume_coll.find_one({"user_id": user_id}, projection)
     if not doc:
         return {}
     return doc
 
 
 # --------- Cover Letter (OpenAI) ---------
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+SYSTEM_PROMPT = (
+    "You are SENSAI, a professional career assistant. Craft tailored, concise, compelling "
+    "cover letters with a confident, friendly tone. Keep to ~250-350 words."
+)
+
+USER_PROMPT_TEMPLATE = (
+    "Candidate: {name}\n"
+    "Target Role: {title} at {company}.\n"
+    "Job Description:\n{description}\n\n"
+    "Write a cover letter that highlights relevant skills and impact. Use a clean structure: "
+    "intro, two short body paragraphs (skills + achievements), closing with a call to action."
+)
+
+# Identical (company, title, JD, name) requests replay the cached token
+# stream instead of paying OpenAI latency and tokens again.
+_cover_letter_cache = TTLCache(maxsize=1024, ttl=3600)
+_cover_letter_hits = 0
+_cover_letter_misses = 0
+
+
+def _cover_letter_key(payload: CoverLetterIn):
+    jd_digest = hashlib.blake2b(
+        payload.job_description.encode(), digest_size=16
+    ).hexdigest()
+    return (payload.company_name, payload.job_title, jd_digest, payload.user_name)
+
+
 @app.post("/api/cover-letter")
-def generate_cover_letter(payload: CoverLetterIn):
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+async def generate_cover_letter(payload: CoverLetterIn):
+    global _cover_letter_hits, _cover_letter_misses
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=400, detail="OPENAI_API_KEY not set")
 
-    system_prompt = (
-        "You are SENSAI, a professional career assistant. Craft tailored, concise, compelling "
-        "cover letters with a confident, friendly tone. Keep to ~250-350 words."
-    )
+    cache_key = _cover_letter_key(payload)
+    cached_tokens = _cover_letter_cache.get(cache_key)
+    if cached_tokens is not None:
+        _cover_letter_hits += 1
 
-    user_prompt = (
-        f"Candidate: {payload.user_name or 'The candidate'}\n"
-        f"Target Role: {payload.job_title} at {payload.company_name}.\n"
-        f"Job Description:\n{payload.job_description}\n\n"
-        "Write a cover letter that highlights relevant skills and impact. Use a clean structure: "
-        "intro, two short body paragraphs (skills + achievements), closing with a call to action."
-    )
+        async def replay_generator():
+            for token in cached_tokens:
+                yield f"data: {token}\n\n"
+
+        return StreamingResponse(replay_generator(), media_type="text/event-stream")
+    _cover_letter_misses += 1
+
+    user_prompt = USER_PROMPT_TEMPLATE.format_map({
+        "name": payload.user_name or "The candidate",
+        "title": payload.job_title,
+        "company": payload.company_name,
+        "description": payload.job_description,
+    })
 
-    url = "https://api.openai.com/v1/chat/completions"
     body = {
-        "model": os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+        "model": OPENAI_MODEL,
         "messages": [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
         "temperature": 0.7,
+        "stream": True,
     }
 
     headers = {
-        "Authorization": f"Bearer {api_key}",
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
         "Content-Type": "application/json",
     }
 
+    # Open the upstream stream before committing our response so connect
+    # failures and OpenAI 4xx/5xx still surface as a real HTTP error
+    upstream_request = openai_client.build_request(
+        "POST", OPENAI_URL, json=body, headers=headers
+    )
     try:
-        resp = requests.post(url, json=body, headers=headers, timeout=30)
-        if resp.status_code >= 400:
-            raise HTTPException(status_code=500, detail=f"OpenAI error: {resp.text[:200]}")
-        data = resp.json()
-        text = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-        return {"text": text}
-    except Exception as e:
+        resp = await openai_client.send(upstream_request, stream=True)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if resp.status_code >= 400:
+        detail = (await resp.aread()).decode(errors="replace")
+        await resp.aclose()
+        raise HTTPException(status_code=500, detail=f"OpenAI error: {detail[:200]}")
+
+    async def event_generator():
+        tokens = []
+        try:
+            async for line in resp.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                chunk = line[len("data: "):]
+                if chunk == "[DONE]":
+                    break
+                delta = orjson.loads(chunk).get("choices", [{}])[0].get("delta", {})
+                token = delta.get("content")
+                if token:
+                    tokens.append(token)
+                    yield f"data: {token}\n\n"
+        except httpx.HTTPError as e:
+            # Headers are already sent; emit a terminal error event instead
+            # of dying with a traceback mid-stream
+            yield f"event: error\ndata: {str(e)[:200]}\n\n"
+            return
+        finally:
+            await resp.aclose()
+        # Only populate the cache once the stream finished cleanly
+        if tokens:
+            _cover_letter_cache[cache_key] = tokens
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+
+@app.get("/api/stats")
+async def get_cache_stats():
+    total = _cover_letter_hits + _cover_letter_misses
+    return {
+        "cover_letter_cache": {
+            "hits": _cover_letter_hits,
+            "misses": _cover_letter_misses,
+            "hit_rate": round(_cover_letter_hits / total, 3) if total else 0.0,
+            "size": len(_cover_letter_cache),
+            "maxsize": _cover_letter_cache.maxsize,
+            "ttl": _cover_letter_cache.ttl,
+        }
+    }
 
 
 # --------- Insights (Mock) ---------
+INSIGHTS = {
+    "market_outlook": "Positive",
+    "industry_growth": 8.5,
+    "demand_level": "High",
+    "top_skills": [
+        "Python",
+        "SQL",
+        "Machine Learning",
+        "Data Engineering",
+        "Cloud (AWS/GCP)",
+        "LLMs",
+    ],
+    "salary_ranges": [
+        {"role": "Data Scientist", "min": 110, "max": 180},
+        {"role": "Data Engineer", "min": 120, "max": 190},
+        {"role": "ML Engineer", "min": 130, "max": 210},
+        {"role": "Analytics Engineer", "min": 105, "max": 160},
+        {"role": "AI Product Manager", "min": 130, "max": 200},
+    ],
+    "trends": [
+        "Rise of LLM applications and AI copilots",
+        "Data quality and governance as differentiators",
+        "Real-time analytics and streaming architectures",
+        "MLOps maturity: monitoring, rollback, and evaluation",
+    ],
+    "recommended_skills": [
+        "Vector databases",
+        "Prompt engineering",
+        "Airflow / Dagster",
+        "dbt",
+        "Kubernetes",
+    ],
+}
+
+# Serialized once at import time; the payload is static so repeat requests
+# can be answered with a 304 instead of re-encoding and re-sending it.
+_INSIGHTS_BYTES = orjson.dumps(INSIGHTS)
+_INSIGHTS_ETAG = hashlib.md5(_INSIGHTS_BYTES).hexdigest()
+_INSIGHTS_HEADERS = {"ETag": _INSIGHTS_ETAG, "Cache-Control": "public, max-age=3600"}
+
+
 @app.get("/api/insights")
-def get_insights():
-    return {
-        "market_outlook": "Positive",
-        "industry_growth": 8.5,
-        "demand_level": "High",
-        "top_skills": [
-            "Python",
-            "SQL",
-            "Machine Learning",
-            "Data Engineering",
-            "Cloud (AWS/GCP)",
-            "LLMs",
-        ],
-        "salary_ranges": [
-            {"role": "Data Scientist", "min": 110, "max": 180},
-            {"role": "Data Engineer", "min": 120, "max": 190},
-            {"role": "ML Engineer", "min": 130, "max": 210},
-            {"role": "Analytics Engineer", "min": 105, "max": 160},
-            {"role": "AI Product Manager", "min": 130, "max": 200},
-        ],
-        "trends": [
-            "Rise of LLM applications and AI copilots",
-            "Data quality and governance as differentiators",
-            "Real-time analytics and streaming architectures",
-            "MLOps maturity: monitoring, rollback, and evaluation",
-        ],
-        "recommended_skills": [
-            "Vector databases",
-            "Prompt engineering",
-            "Airflow / Dagster",
-            "dbt",
-            "Kubernetes",
-        ],
-    }
+async def get_insights(request: Request):
+    if request.headers.get("if-none-match") == _INSIGHTS_ETAG:
+        return Response(status_code=304, headers=_INSIGHTS_HEADERS)
+    return Response(
+        content=_INSIGHTS_BYTES,
+        media_type="application/json",
+        headers=_INSIGHTS_HEADERS,
+    )
+
+
+# list_collection_names is a server round trip; refresh at most once a minute
+_collections_cache = TTLCache(maxsize=1, ttl=60)
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
+    if not ENABLE_DEBUG_ENDPOINTS:
+        raise HTTPException(status_code=404, detail="Not Found")
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -237,7 +435,10 @@ def test_database():
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = _collections_cache.get("names")
+                if collections is None:
+                    collections = await db.list_collection_names()
+                    _collections_cache["names"] = collections
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -247,12 +448,22 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if DATABASE_URL_SET else "❌ Not Set"
+    response["database_name"] = "✅ Set" if DATABASE_NAME_SET else "❌ Not Set"
     return response
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+    # workers > 1 requires the app as an import string, not the instance
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        proxy_headers=True,
+    )
@@ -31,7 +31,7 @@ class ResumeExperience(BaseModel):
     role: str
     start: str
     end: str
-    description: Optional[str] = None
+    description: Optional[str] = Field(None, max_length=2000)
 
 
 class ResumeEducation(BaseModel):
@@ -39,13 +39,13 @@ class ResumeEducation(BaseModel):
     degree: str
     start: str
     end: str
-    details: Optional[str] = None
+    details: Optional[str] = Field(None, max_length=2000)
 
 
 class ResumeProject(BaseModel):
     name: str
     link: Optional[str] = None
-    description: Optional[str] = None
+    description: Optional[str] = Field(None, max_length=2000)
 
 
 class Resume(BaseModel):
@@ -53,8 +53,19 @@ class Resume(BaseModel):
     email: Optional[str] = None
     linkedin: Optional[str] = None
     twitter: Optional[str] = None
-    summary: Optional[str] = None
+    summary: Optional[str] = Field(None, max_length=4000)
     skills: List[str] = []
     experiences: List[ResumeExperience] = []
     education: List[ResumeEducation] = []
     projects: List[ResumeProject] = []
+
+
+class CoverLetterIn(BaseModel):
+    # Bound input sizes so oversized job descriptions are rejected with a
+    # 422 before anything is forwarded to OpenAI
+    model_config = {"str_strip_whitespace": True}
+
+    company_name: str = Field(..., max_length=200)
+    job_title: str = Field(..., max_length=200)
+    job_description: str = Field(..., max_length=8000)
+    user_name: Optional[str] = Field(None, max_length=120)